@@ -1,23 +1,35 @@
 #!/usr/bin/env python3
 '''Cut new release'''
 import argparse
-from functools import total_ordering
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import io
 import os
 import re
-import shutil
 import subprocess
-import tempfile
 import time
 
 import requests
 from uritemplate import expand
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+try:
+    from pykwalify.core import Core
+except ImportError:
+    # No validation
+    Core = None
 
 
 VERSION_FMT = (r'^(?P<major>\d+)\.(?P<minor>\d+)\.(?P<micro>\d+)'
-               r'(?P<prerelease>(b|(beta)|a|(alpha))(\d+)?)?'
+               r'(?P<prerelease>(?P<pretype>b|beta|a|alpha)(?P<prenum>\d+)?)?'
                r'(?P<revision>\+[A-Za-z0-9]+)?$')
+_VERSION_RE = re.compile(VERSION_FMT)
+_PRERELEASE_ORDER = {'a': 0, 'b': 1, 'r': 2}
 SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+SCHEMA_PATH = os.path.join(SRC_DIR, 'config_schema.yaml')
 
 
 def check_version(version):
@@ -26,11 +38,10 @@ def check_version(version):
     Version should be well-formed, larger than current version and not already
     exist
     '''
-    if not re.match(VERSION_FMT, version):
+    if not _VERSION_RE.match(version):
         raise ValueError(f'Invalid version: {version}')
 
 
-@total_ordering
 class Version:
     def __init__(self, string='', version_tuple=None):
         pre = None
@@ -40,21 +51,16 @@ class Version:
             if string.startswith('v'):
                 string = string[1:]
 
-            match = re.match(VERSION_FMT, string)
+            match = _VERSION_RE.match(string)
             if not match:
                 raise ValueError(f'Invalid version: {string}')
             self.major = int(match.group('major'))
             self.minor = int(match.group('minor'))
             self.micro = int(match.group('micro'))
-            pre = match.group('prerelease')
+            pre = match.group('pretype')
             if pre is not None:
-                if pre.startswith('b'):
-                    self.prerelease_type = 'b'
-                    prerelease_number = pre.strip('beta').strip('b')
-                elif pre.startswith('a'):
-                    self.prerelease_type = 'a'
-                    prerelease_number = pre.strip('alpha').strip('a')
-
+                self.prerelease_type = pre[0]
+                prerelease_number = match.group('prenum')
                 if prerelease_number:
                     self.prerelease_number = int(prerelease_number)
                 else:
@@ -80,72 +86,101 @@ class Version:
         if rev is not None:
             self.revision = rev.strip('+')
 
+        rev = f'+{self.revision}' if self.revision else ''
+        self._str = (f'{self.major}.{self.minor}.{self.micro}'
+                     f'{self._prerelease_string()}{rev}')
+        # A release without a revision sorts after the same release with one
+        self._key = (self.major, self.minor, self.micro,
+                     _PRERELEASE_ORDER[self.prerelease_type],
+                     self.prerelease_number,
+                     self.revision is None, self.revision or '')
+
     def _prerelease_string(self):
         if self.prerelease_type in ('a', 'b'):
-            fmt = '{prefix}{prerelease}'
-            return fmt .format(prefix=self.prerelease_type,
-                               prerelease=self.prerelease_number)
+            return f'{self.prerelease_type}{self.prerelease_number}'
         return ''
 
     def __str__(self):
-        fmt = '{major}.{minor}.{micro}{beta}{rev}'
-
-        if self.revision:
-            rev = '+{}'.format(self.revision)
-        else:
-            rev = ''
-
-        return fmt.format(major=self.major,
-                          minor=self.minor,
-                          micro=self.micro,
-                          beta=self._prerelease_string(),
-                          rev=rev)
-
-    def __eq__(self, other):
-        return str(self) == str(other)
+        return self._str
 
     @property
     def version_tuple(self):
         return (self.major, self.minor, self.micro, self.prerelease_type,
                 self.prerelease_number, self.revision)
 
+    def __eq__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self._key == other._key
+
+    def __lt__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self._key < other._key
+
+    def __le__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self._key <= other._key
+
     def __gt__(self, other):
-        if self.version_tuple[:5] == other.version_tuple[:5]:
-            return (self.version_tuple[5] is None and
-                    other.version_tuple[5] is not None)
-        else:
-            return self.version_tuple[:5] > other.version_tuple[:5]
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self._key > other._key
+
+    def __ge__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self._key >= other._key
 
 
 def get_last_version():
     '''Get last version from git tags'''
-    proc = subprocess.run(['git', 'tag'], universal_newlines=True,
-                          stdout=subprocess.PIPE)
+    # git only orders tags by version within a prefix: all v-prefixed tags
+    # sort above bare numeric ones. Within a prefix, versionsort.suffix makes
+    # 1.0.0a1 and 1.0.0+abc sort below 1.0.0 as in Version, so the first tag
+    # that parses for each prefix is the newest with that prefix.
+    proc = subprocess.run(['git',
+                           '-c', 'versionsort.suffix=a',
+                           '-c', 'versionsort.suffix=b',
+                           '-c', 'versionsort.suffix=+',
+                           'tag', '--list', '--sort=-v:refname'],
+                          universal_newlines=True, stdout=subprocess.PIPE)
     tags = proc.stdout.splitlines()
-    newest = Version(version_tuple=(0, 0, 0))
+    newest = {}
     for tag in tags:
+        prefixed = tag.startswith('v')
+        if prefixed in newest:
+            continue
         try:
-            version = Version(string=tag)
+            newest[prefixed] = Version(string=tag)
         except ValueError:
             continue
+        if len(newest) == 2:
+            break
 
-        if version > newest:
-            newest = version
-
-    return version
+    return max(newest.values(), default=Version(version_tuple=(0, 0, 0)))
 
 
+@lru_cache(maxsize=1)
 def get_git_root():
     proc = subprocess.run(['git', 'rev-parse', '--show-toplevel'],
                           universal_newlines=True, stdout=subprocess.PIPE)
     return proc.stdout.strip()
 
 
+@lru_cache(maxsize=None)
+def _compile_pattern(regex):
+    '''Compile version string pattern, shared across files and calls'''
+    return re.compile(regex)
+
+
 def get_current_version(path, pattern):
     git_root = get_git_root()
+    regex = _compile_pattern(pattern)
     with open(os.path.join(git_root, path)) as file_:
-        for line in file_.readlines():
-            match = re.search(pattern, line)
+        for line in file_:
+            match = regex.search(line)
             if match:
                 return Version(string=match.group("release"))
 
@@ -163,86 +198,109 @@ def check_versions(last_version, current_version, release):
 
 
 def replace_string(filepath, regex, replacement):
-    pattern = re.compile(regex)
-    with tempfile.NamedTemporaryFile(mode='w', delete=False) as tmp_file:
-        with open(filepath) as src_file:
-            for line in src_file:
-                match = pattern.search(line)
-                if match:
-                    new_line = (line[:match.start('release')] +
-                                str(replacement) +
-                                line[match.end('release'):])
-                    tmp_file.write(new_line)
-                else:
-                    tmp_file.write(line)
+    pattern = _compile_pattern(regex)
+    with open(filepath) as src_file:
+        data = src_file.read()
+
+    new_lines = []
+    for line in io.StringIO(data):
+        match = pattern.search(line)
+        if match:
+            line = (line[:match.start('release')] +
+                    str(replacement) +
+                    line[match.end('release'):])
+        new_lines.append(line)
+    new_data = ''.join(new_lines)
+
+    if new_data == data:
+        return False
 
-    shutil.copystat(filepath, tmp_file.name)
-    shutil.move(tmp_file.name, filepath)
+    with open(filepath, 'w') as dest_file:
+        dest_file.write(new_data)
+    return True
 
 
 def update_version(release, version_strings):
     'Update repo contents for new release and commit changes'
-    check_git_clean()
+    worktree_clean, index_clean = git_status()
+    if not worktree_clean:
+        raise Exception('Git state not clean when it should be.')
 
     git_root = get_git_root()
+    paths = []
+    changed = False
     for file_spec in version_strings:
         path = os.path.join(git_root, file_spec['path'])
-        replace_string(path, file_spec['pattern'], release)
+        changed |= replace_string(path, file_spec['pattern'], release)
+        paths.append(path)
 
-        subprocess.run(['git', 'add', path], check=True)
+    if paths:
+        subprocess.run(['git', 'add', '--'] + paths, check=True)
 
-    if not git_clean(cached=True):
+    # The work tree was clean, so after staging the index only differs from
+    # HEAD if something was already staged or a version string changed
+    if changed or not index_clean:
         msg = 'Version {}'.format(release)
         subprocess.run(['git', 'commit', '-m', msg], check=True)
     tag = 'v{}'.format(release)
     subprocess.run(['git', 'tag', tag], check=True)
 
 
-def git_clean(cached=False):
-    cmd = ['git', 'diff', '--quiet']
-    if cached:
-        cmd.append('--cached')
-    proc = subprocess.run(cmd)
-    return proc.returncode == 0
-
-
-def check_git_clean():
-    if not git_clean():
-        raise Exception('Git state not clean when it should be.')
-
+def git_status():
+    '''Return whether the work tree and the index are clean
 
-def build(release):
-    orig_dir = os.path.abspath(os.curdir)
+    Untracked files are ignored.
+    '''
+    proc = subprocess.run(['git', 'status', '--porcelain',
+                           '--untracked-files=no'],
+                          universal_newlines=True, stdout=subprocess.PIPE,
+                          check=True)
+    lines = proc.stdout.splitlines()
+    index_clean = all(line[0] == ' ' for line in lines)
+    worktree_clean = all(line[1] == ' ' for line in lines)
+    return worktree_clean, index_clean
+
+
+def build(release, parallelism=None):
+    if parallelism is None:
+        parallelism = os.cpu_count() or 1
     git_root = get_git_root()
-    os.chdir(git_root)
-    subprocess.run(['make', 'clean'], check=True)
-    subprocess.run(['make'], check=True)
-    os.chdir(orig_dir)
+    subprocess.run(['make', 'clean'], cwd=git_root, check=True)
+    subprocess.run(['make', f'-j{parallelism}'], cwd=git_root, check=True)
 
 
 def github_release(release, user, repo, token, assets):
     api_url = 'https://api.github.com/repos/{user}/{repo}/releases'
     api_url = api_url.format(user=user, repo=repo)
 
+    git_root = get_git_root()
+    with open(os.path.join(git_root, token)) as token_file:
+        token = token_file.read().strip()
+
+    session = requests.Session()
+    session.headers.update({'Authorization': 'token {}'.format(token)})
+
+    tag_url = api_url + '/tags/{release}'.format(release=release)
+
+    def release_exists():
+        req = session.head(tag_url, allow_redirects=True)
+        if req.status_code == 404:
+            return False
+        req.raise_for_status()
+        return True
+
     def get_release_json():
-        tag_url = api_url + '/tags/{release}'.format(release=release)
-        req = requests.get(tag_url)
+        req = session.get(tag_url)
         release_json = req.json()
         if ('message' in release_json and
                 release_json['message'] == 'Not Found'):
             return False
         return release_json
 
-    release_json = get_release_json()
-
-    with open(os.path.join(get_git_root(), token)) as token_file:
-        token = token_file.read().strip()
-
-    if not release_json:
-        headers = {'Authorization': 'token {}'.format(token)}
-        req = requests.post(api_url,
-                            json={'tag_name': release},
-                            headers=headers)
+    if release_exists():
+        release_json = get_release_json()
+    else:
+        req = session.post(api_url, json={'tag_name': release})
         req.raise_for_status()
         release_json = get_release_json()
         for wait in (1, 1, 2, 2, 5, 5, 10, 10, 10, 30, 60, 120):
@@ -256,16 +314,19 @@ def github_release(release, user, repo, token, assets):
         if not release_json:
             raise RuntimeError("Timed out waiting for GitHub release creation!")
 
-    for file_ in assets:
+    def upload_asset(file_):
         upload_url = expand(release_json['upload_url'],
                             {'name': os.path.basename(file_['path'])})
-        headers = {'Content-Type': file_['type'],
-                   'Authorization': 'token {}'.format(token)}
-        req = requests.post(upload_url, headers=headers,
-                            data=open(os.path.join(get_git_root(),
-                                                   file_['path']), 'rb'))
+        path = os.path.join(git_root, file_['path'])
+        headers = {'Content-Type': file_['type']}
+        with open(path, 'rb') as asset_file:
+            req = session.post(upload_url, headers=headers, data=asset_file)
         req.raise_for_status()
 
+    if assets:
+        with ThreadPoolExecutor(max_workers=min(8, len(assets))) as executor:
+            list(executor.map(upload_asset, assets))
+
 
 def push_release(release, config):
     subprocess.run(['git', 'push'])
@@ -284,12 +345,16 @@ def update_to_alpha(release, version_strings):
                                          'a',
                                          1))
     git_root = get_git_root()
+    paths = []
     for file_spec in version_strings:
         if file_spec.get('skip_alpha'):
             continue
         path = os.path.join(git_root, file_spec['path'])
         replace_string(path, file_spec['pattern'], new_release)
-        subprocess.run(['git', 'add', path], check=True)
+        paths.append(path)
+
+    if paths:
+        subprocess.run(['git', 'add', '--'] + paths, check=True)
 
     msg = 'Bump version to beta {}'.format(new_release)
     subprocess.run(['git', 'commit', '-m', msg], check=True)
@@ -312,15 +377,12 @@ def main():
     args = parse_args()
 
     with open(args.config) as file_:
-        config = yaml.load(file_, Loader=yaml.SafeLoader)
-    try:
-        from pykwalify.core import Core
-        core = Core(source_data=config,
-                    schema_files=[os.path.join(SRC_DIR, "config_schema.yaml")])
+        config = yaml.load(file_, Loader=SafeLoader)
+    if Core is not None:
+        with open(SCHEMA_PATH) as file_:
+            schema = yaml.load(file_, Loader=SafeLoader)
+        core = Core(source_data=config, schema_data=schema)
         core.validate(raise_exception=True)
-    except ImportError:
-        # No validation
-        pass
 
     # Get versions
     last_version = get_last_version()
@@ -332,7 +394,7 @@ def main():
 
     update_version(release, config['version_strings'])
 
-    build(release)
+    build(release, **(config.get('build') or {}))
 
     push_release(release, config)
 